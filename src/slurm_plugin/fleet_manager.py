@@ -9,39 +9,97 @@
 # OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and
 # limitations under the License.
 import contextlib
-import copy
 import logging
-import secrets
+import random
 import time
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime
+from itertools import chain
 
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
 from common.ec2_utils import get_private_ip_address_and_dns_name
-from common.utils import setup_logging_filter
+from common.utils import grouper, setup_logging_filter
 from slurm_plugin.common import print_with_count
 
 logger = logging.getLogger(__name__)
 
+# Defaults for the boto3 config of the fleet managers, the options explicitly set by the caller take precedence.
+# Adaptive retry mode applies client-side rate limiting when EC2 throttles the requests, and a larger connection pool
+# avoids requests waiting for a free connection when multiple calls are performed concurrently.
+DEFAULT_BOTO3_CONFIG = Config(retries={"max_attempts": 5, "mode": "adaptive"}, max_pool_connections=50)
 
-class EC2Instance:
-    def __init__(self, id, private_ip, hostname, launch_time):
-        """Initialize slurm node with attributes."""
-        self.id = id
-        self.private_ip = private_ip
-        self.hostname = hostname
-        self.launch_time = launch_time
-        self.slurm_node = None
+# Delays in seconds for the retries of the DescribeInstances calls.
+# With equal jitter and 5 attempts, the cumulative wait is between 9 and 18 seconds.
+BASE_BACKOFF_DELAY = 0.6
+MAX_BACKOFF_DELAY = 30
+
+# Maximum number of instance ids accepted by a DescribeInstances call
+DESCRIBE_INSTANCES_MAX_IDS = 500
+# Maximum number of parallel DescribeInstances calls performed by a manager for the chunks of instance ids
+DESCRIBE_INSTANCES_MAX_WORKERS = 4
+
+# Error codes returned by EC2 when the API requests are throttled
+THROTTLING_ERROR_CODES = {
+    "RequestLimitExceeded",
+    "Throttling",
+    "ThrottlingException",
+    "EC2ThrottledException",
+    "RequestThrottled",
+}
+
+# The overrides module is only available when executing manual tests or integration tests,
+# so look it up once at import time rather than on every launch.
+try:
+    from slurm_plugin.overrides import run_instances as _run_instances_override
+except ImportError:
+    _run_instances_override = None
+
+try:
+    from slurm_plugin.overrides import create_fleet as _create_fleet_override
+except ImportError:
+    _create_fleet_override = None
+
+
+# Fields of the DescribeInstances response required to build an EC2Instance
+_REQUIRED_INSTANCE_FIELDS = ("InstanceId", "LaunchTime", "PrivateIpAddress", "PrivateDnsName", "NetworkInterfaces")
+
+
+def _has_required_instance_fields(instance_info):
+    """
+    Check if the instance info contains all the fields required to build an EC2Instance.
 
-    def __eq__(self, other):
-        """Compare 2 SlurmNode objects."""
-        if isinstance(other, EC2Instance):
-            return self.__dict__ == other.__dict__
+    The network interfaces are checked in the same way as get_private_ip_address_and_dns_name reads them.
+    """
+    if not all(field in instance_info for field in _REQUIRED_INSTANCE_FIELDS):
         return False
+    for network_interface in instance_info["NetworkInterfaces"]:
+        attachment = network_interface.get("Attachment")
+        if attachment is None:
+            return False
+        if attachment.get("DeviceIndex", -1) == 0 and attachment.get("NetworkCardIndex", -1) == 0:
+            break
+    return True
+
 
-    def __repr__(self):
-        attrs = ", ".join(["{key}={value}".format(key=key, value=repr(value)) for key, value in self.__dict__.items()])
-        return "{class_name}({attrs})".format(class_name=self.__class__.__name__, attrs=attrs)
+@dataclass
+class EC2Instance:
+    # Slots avoid a per-instance __dict__, since many EC2Instance objects are created at every scaling iteration.
+    # Declared explicitly because dataclass(slots=True) requires Python 3.10.
+    __slots__ = ("id", "private_ip", "hostname", "launch_time", "slurm_node")
+
+    id: str
+    private_ip: str
+    hostname: str
+    launch_time: datetime
+
+    def __post_init__(self):
+        # Not a dataclass field: the associated SlurmNode refers back to this instance,
+        # so it must not be part of the generated __eq__ and __repr__
+        self.slurm_node = None
 
     def __str__(self):
         return f"{self.id}"
@@ -51,17 +109,18 @@ class EC2Instance:
 
     @staticmethod
     def from_describe_instance_data(instance_info):
-        try:
-            private_ip, private_dns_name = get_private_ip_address_and_dns_name(instance_info)
-            return EC2Instance(
-                instance_info["InstanceId"],
-                private_ip,
-                private_dns_name.split(".")[0],
-                instance_info["LaunchTime"],
-            )
-        except KeyError as e:
-            logger.error("Unable to retrieve EC2 instance info: %s", e)
-            raise e
+        """
+        Build an EC2Instance from the info returned by a DescribeInstances call.
+
+        :raises KeyError if the instance info misses any of the required fields
+        """
+        private_ip, private_dns_name = get_private_ip_address_and_dns_name(instance_info)
+        return EC2Instance(
+            instance_info["InstanceId"],
+            private_ip,
+            private_dns_name.split(".")[0],
+            instance_info["LaunchTime"],
+        )
 
 
 class FleetManagerException(Exception):
@@ -130,7 +189,6 @@ class FleetManagerFactory:
 class FleetManager(ABC):
     """Abstract Fleet Manager."""
 
-    @abstractmethod
     def __init__(
         self,
         cluster_name,
@@ -144,12 +202,22 @@ class FleetManager(ABC):
     ):
         self._cluster_name = cluster_name
         self._region = region
-        self._boto3_config = boto3_config
+        self._boto3_config = DEFAULT_BOTO3_CONFIG.merge(boto3_config)
         self._queue = queue
         self._compute_resource = compute_resource
         self._compute_resource_config = compute_resource_config
         self._all_or_nothing = all_or_nothing
         self._launch_overrides = launch_overrides
+        # LaunchTemplate is different for every compute resources in every queue
+        self._launch_template_name = f"{cluster_name}-{queue}-{compute_resource}"
+        self._ec2_client = None
+
+    @property
+    def ec2_client(self):
+        """Return the EC2 client, created on first access and reused for all the calls of the manager."""
+        if self._ec2_client is None:
+            self._ec2_client = boto3.client("ec2", region_name=self._region, config=self._boto3_config)
+        return self._ec2_client
 
     @abstractmethod
     def _evaluate_launch_params(self, count):
@@ -173,50 +241,34 @@ class FleetManager(ABC):
 
             launch_params = self._evaluate_launch_params(count)
             assigned_nodes = self._launch_instances(launch_params)
-            if len(assigned_nodes.get("Instances")) > 0:
-                logger.info(
-                    "Launched the following instances %s",
-                    print_with_count([instance.get("InstanceId", "") for instance in assigned_nodes.get("Instances")]),
-                )
-                logger.debug("Full launched instances information: %s", assigned_nodes.get("Instances"))
+            instances = assigned_nodes.get("Instances") or []
+            if not instances:
+                return []
 
-        return [EC2Instance.from_describe_instance_data(instance_info) for instance_info in assigned_nodes["Instances"]]
+            logger.info(
+                "Launched the following instances %s",
+                print_with_count([instance.get("InstanceId", "") for instance in instances]),
+            )
+            logger.debug("Full launched instances information: %s", instances)
+
+        try:
+            return [EC2Instance.from_describe_instance_data(instance_info) for instance_info in instances]
+        except KeyError as e:
+            logger.error("Unable to retrieve EC2 instance info: %s", e)
+            raise e
 
 
 class Ec2RunInstancesManager(FleetManager):
     """Manager to create EC2 instances fleet using EC2 run_instances API."""
 
-    def __init__(
-        self,
-        cluster_name,
-        region,
-        boto3_config,
-        queue,
-        compute_resource,
-        compute_resource_config,
-        all_or_nothing,
-        launch_overrides,
-    ):
-        super().__init__(
-            cluster_name,
-            region,
-            boto3_config,
-            queue,
-            compute_resource,
-            compute_resource_config,
-            all_or_nothing,
-            launch_overrides,
-        )
-
     def _evaluate_launch_params(self, count):
         """Evaluate parameters to be passed to run_instances call."""
         launch_params = {
             # Set MinCount to "count" to make the run_instances call fail if entire count cannot be satisfied
             "MinCount": 1 if not self._all_or_nothing else count,
             "MaxCount": count,
-            # LaunchTemplate is different for every compute resources in every queue
             "LaunchTemplate": {
-                "LaunchTemplateName": f"{self._cluster_name}-{self._queue}-{self._compute_resource}",
+                "LaunchTemplateName": self._launch_template_name,
                 "Version": "$Latest",
             },
         }
@@ -229,7 +281,9 @@ class Ec2RunInstancesManager(FleetManager):
     def _launch_instances(self, launch_params):
         """Launch a batch of ec2 instances."""
         try:
-            return run_instances(self._region, self._boto3_config, launch_params)
+            return run_instances(
+                self._region, self._boto3_config, launch_params, ec2_client_factory=lambda: self.ec2_client
+            )
         except ClientError as e:
             logger.error("Failed RunInstances request: %s", e.response.get("ResponseMetadata").get("RequestId"))
             raise e
@@ -259,34 +313,35 @@ class Ec2CreateFleetManager(FleetManager):
             all_or_nothing,
             launch_overrides,
         )
+        # The compute resource config doesn't change during the lifetime of the manager
+        self._single_instance_type = len(compute_resource_config.get("Instances", [])) == 1
+        self._single_az = len(compute_resource_config.get("Networking", {}).get("SubnetIds", [])) == 1
 
     def _evaluate_template_overrides(self) -> list:
         """Build and return the list of Launch Template Overrides to be applied in the CreateFleet request.
 
         (https://docs.aws.amazon.com/AWSEC2/latest/APIReference/API_FleetLaunchTemplateOverridesRequest.html)
         """
-        template_overrides = []
-        overrides = {}
-
+        base_overrides = {}
         if self._compute_resource_config["CapacityType"] == "spot":
             if self._compute_resource_config.get("MaxPrice"):
-                overrides.update({"MaxPrice": str(self._compute_resource_config["MaxPrice"])})
+                base_overrides["MaxPrice"] = str(self._compute_resource_config["MaxPrice"])
 
-        for instance_type in self._compute_resource_config["Instances"]:
-            subnet_ids = self._compute_resource_config["Networking"]["SubnetIds"]
-            for subnet_id in subnet_ids:
-                overrides.update({"InstanceType": instance_type["InstanceType"], "SubnetId": subnet_id})
-                template_overrides.append(copy.deepcopy(overrides))
-        return template_overrides
+        subnet_ids = self._compute_resource_config["Networking"]["SubnetIds"]
+        # All the values are strings, so a shallow copy of the base overrides is enough
+        return [
+            {**base_overrides, "InstanceType": instance_type["InstanceType"], "SubnetId": subnet_id}
+            for instance_type in self._compute_resource_config["Instances"]
+            for subnet_id in subnet_ids
+        ]
 
     def _uses_single_instance_type(self):
         """Check if the compute resource uses only one instance type."""
-        return len(self._compute_resource_config["Instances"]) == 1
+        return self._single_instance_type
 
     def _uses_single_az(self):
         """Check if the queue uses only one Subnet Id."""
-        subnet_ids = self._compute_resource_config.get("Networking", {}).get("SubnetIds", [])
-        return len(subnet_ids) == 1
+        return self._single_az
 
     def _evaluate_launch_params(self, count):
         """Evaluate parameters to be passed to create_fleet call."""
@@ -325,8 +380,7 @@ class Ec2CreateFleetManager(FleetManager):
                 "LaunchTemplateConfigs": [
                     {
                         "LaunchTemplateSpecification": {
-                            # LaunchTemplate is different for every compute resources in every queue
-                            "LaunchTemplateName": f"{self._cluster_name}-{self._queue}-{self._compute_resource}",
+                            "LaunchTemplateName": self._launch_template_name,
                             "Version": "$Latest",
                         },
                         "Overrides": template_overrides,
@@ -356,21 +410,26 @@ class Ec2CreateFleetManager(FleetManager):
     def _launch_instances(self, launch_params):
         """Launch a batch of ec2 instances."""
         try:
-            response = create_fleet(self._region, self._boto3_config, launch_params)
+            response = create_fleet(
+                self._region, self._boto3_config, launch_params, ec2_client_factory=lambda: self.ec2_client
+            )
             logger.debug("CreateFleet response: %s", response)
 
             instances = response.get("Instances", [])
-            log_level = logging.WARNING if instances else logging.ERROR
-            for err in response.get("Errors", []):
-                logger.log(
-                    log_level,
-                    "Error in CreateFleet request (%s): %s - %s",
-                    response.get("ResponseMetadata", {}).get("RequestId"),
-                    err.get("ErrorCode"),
-                    err.get("ErrorMessage"),
-                )
-
-            instance_ids = [inst_id for instance in instances for inst_id in instance["InstanceIds"]]
+            errors = response.get("Errors")
+            if errors:
+                log_level = logging.WARNING if instances else logging.ERROR
+                request_id = response.get("ResponseMetadata", {}).get("RequestId")
+                for err in errors:
+                    logger.log(
+                        log_level,
+                        "Error in CreateFleet request (%s): %s - %s",
+                        request_id,
+                        err.get("ErrorCode"),
+                        err.get("ErrorMessage"),
+                    )
+
+            instance_ids = list(chain.from_iterable(instance["InstanceIds"] for instance in instances))
             instances, partial_instance_ids = self._get_instances_info(instance_ids)
             if partial_instance_ids:
                 logger.error("Unable to retrieve instance info for instances: %s", partial_instance_ids)
@@ -392,77 +451,138 @@ class Ec2CreateFleetManager(FleetManager):
 
         retries = 5
         attempt_count = 0
-        # Wait for instances to be available in EC2
-        time.sleep(0.1)
+        # No wait before the first attempt: instances not yet available in EC2 are returned as partial
+        # and retried with backoff, the first retry waiting at least BASE_BACKOFF_DELAY seconds
         while attempt_count < retries and partial_instance_ids:
             complete_instances, partial_instance_ids = self._retrieve_instances_info_from_ec2(partial_instance_ids)
             instances.extend(complete_instances)
             attempt_count += 1
             if attempt_count < retries:
-                time.sleep(0.3 * 2**attempt_count + (secrets.randbelow(500) / 1000))
+                time.sleep(self._get_backoff_delay(attempt_count))
 
         return instances, partial_instance_ids
 
+    @staticmethod
+    def _get_backoff_delay(attempt_count: int):
+        """
+        Return the delay before the next DescribeInstances attempt, using exponential backoff with equal jitter.
+
+        Half of the exponential delay is always waited, to give EC2 the time to make the instances visible,
+        while the jittered half spreads the retries of managers launching instances at the same time.
+        """
+        delay = min(MAX_BACKOFF_DELAY, BASE_BACKOFF_DELAY * 2**attempt_count)
+        # The jitter doesn't need a cryptographically secure generator, so the B311 check is disabled.
+        return delay / 2 + random.uniform(0, delay / 2)  # nosec B311
+
     def _retrieve_instances_info_from_ec2(self, instance_ids: list):
         """
         Retrieve instance info from EC2 by Instance Ids and verify to have required info.
 
+        Instance ids are split in chunks accepted by a single DescribeInstances call,
+        described in parallel when there are more than one.
         :return list of instances with complete information and list of IDs for instances with incomplete information
         """
         complete_instances = []
         partial_instance_ids = []
 
         if instance_ids:
-            try:
-                ec2_client = boto3.client("ec2", region_name=self._region, config=self._boto3_config)
-                paginator = ec2_client.get_paginator("describe_instances")
-                response_iterator = paginator.paginate(InstanceIds=instance_ids)
-                filtered_iterator = response_iterator.search("Reservations[].Instances[]")
-
-                for instance_info in filtered_iterator:
-                    try:
-                        # Try to build EC2Instance objects using all the required fields
-                        EC2Instance.from_describe_instance_data(instance_info)
-                        complete_instances.append(instance_info)
-                    except KeyError as e:
-                        logger.debug("Unable to retrieve instance info: %s", e)
-                        partial_instance_ids.append(instance_info["InstanceId"])
-            except ClientError as e:
+            ec2_client = self.ec2_client
+            chunks = [list(chunk) for chunk in grouper(instance_ids, DESCRIBE_INSTANCES_MAX_IDS)]
+            if len(chunks) > 1:
+                with ThreadPoolExecutor(max_workers=DESCRIBE_INSTANCES_MAX_WORKERS) as executor:
+                    results = list(
+                        executor.map(lambda chunk: self._retrieve_instances_info_chunk(ec2_client, chunk), chunks)
+                    )
+            else:
+                results = [self._retrieve_instances_info_chunk(ec2_client, chunks[0])]
+
+            for chunk_complete_instances, chunk_partial_instance_ids in results:
+                complete_instances.extend(chunk_complete_instances)
+                partial_instance_ids.extend(chunk_partial_instance_ids)
+
+        return complete_instances, partial_instance_ids
+
+    def _retrieve_instances_info_chunk(self, ec2_client, instance_ids: list):
+        """Retrieve instance info for a chunk of Instance Ids and verify to have required info."""
+        complete_instances = []
+        partial_instance_ids = []
+
+        try:
+            instances_info = self._describe_instances(ec2_client, instance_ids)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in THROTTLING_ERROR_CODES:
+                logger.warning("DescribeInstances request throttled, it will be retried: %s", e)
+            else:
+                # e.g. InvalidInstanceID.NotFound is expected until the instances are visible in EC2
                 logger.debug("Unable to retrieve instance info: %s", e)
-                partial_instance_ids.extend(instance_ids)
+            return complete_instances, list(instance_ids)
+
+        for instance_info in instances_info:
+            if _has_required_instance_fields(instance_info):
+                complete_instances.append(instance_info)
+            else:
+                logger.debug("Incomplete instance info: %s", instance_info)
+                partial_instance_ids.append(instance_info["InstanceId"])
 
         return complete_instances, partial_instance_ids
 
+    @staticmethod
+    def _describe_instances(ec2_client, instance_ids: list):
+        """
+        Describe the given instances, stopping as soon as all of them are returned.
 
-def run_instances(region, boto3_config, run_instances_kwargs):
+        :raises ClientError in case of boto3 failure
+        :return list of instances info
+        """
+        instances_info = []
+        remaining_ids = set(instance_ids)
+        # MaxResults can't be used together with InstanceIds, a single call usually returns all the instances
+        describe_kwargs = {"InstanceIds": instance_ids}
+        while True:
+            response = ec2_client.describe_instances(**describe_kwargs)
+            for reservation in response.get("Reservations", []):
+                for instance_info in reservation.get("Instances", []):
+                    instances_info.append(instance_info)
+                    remaining_ids.discard(instance_info["InstanceId"])
+            # Stop when all the requested instances are described, avoiding to fetch further pages
+            if not remaining_ids or not response.get("NextToken"):
+                return instances_info
+            describe_kwargs["NextToken"] = response["NextToken"]
+
+
+def run_instances(region, boto3_config, run_instances_kwargs, ec2_client_factory=None):
     """
     Check whether to override ec2 run_instances.
 
     This function is defined here to be able to overwrite it when executing manual tests or in integration tests.
+    An ec2_client_factory can be passed to reuse an existing client, it's only called when there is no override.
     """
-    try:
-        from slurm_plugin.overrides import run_instances
-
+    if _run_instances_override is not None:
         logger.info("Launching instances with run_instances override API. Parameters: %s", run_instances_kwargs)
-        return run_instances(region=region, boto3_config=boto3_config, **run_instances_kwargs)
-    except ImportError:
-        logger.info("Launching instances with run_instances API. Parameters: %s", run_instances_kwargs)
+        return _run_instances_override(region=region, boto3_config=boto3_config, **run_instances_kwargs)
+
+    logger.info("Launching instances with run_instances API. Parameters: %s", run_instances_kwargs)
+    if ec2_client_factory:
+        ec2_client = ec2_client_factory()
+    else:
         ec2_client = boto3.client("ec2", region_name=region, config=boto3_config)
-        return ec2_client.run_instances(**run_instances_kwargs)
+    return ec2_client.run_instances(**run_instances_kwargs)
 
 
-def create_fleet(region, boto3_config, create_fleet_kwargs):
+def create_fleet(region, boto3_config, create_fleet_kwargs, ec2_client_factory=None):
     """
     Check whether to override ec2 create_fleet.
 
     This function is defined here to be able to overwrite it when executing manual tests or in integration tests.
+    An ec2_client_factory can be passed to reuse an existing client, it's only called when there is no override.
     """
-    try:
-        from slurm_plugin.overrides import create_fleet
-
+    if _create_fleet_override is not None:
         logger.info("Launching instances with create_fleet override API. Parameters: %s", create_fleet_kwargs)
-        return create_fleet(region=region, boto3_config=boto3_config, **create_fleet_kwargs)
-    except ImportError:
-        logger.info("Launching instances with create_fleet API. Parameters: %s", create_fleet_kwargs)
+        return _create_fleet_override(region=region, boto3_config=boto3_config, **create_fleet_kwargs)
+
+    logger.info("Launching instances with create_fleet API. Parameters: %s", create_fleet_kwargs)
+    if ec2_client_factory:
+        ec2_client = ec2_client_factory()
+    else:
         ec2_client = boto3.client("ec2", region_name=region, config=boto3_config)
-        return ec2_client.create_fleet(**create_fleet_kwargs)
+    return ec2_client.create_fleet(**create_fleet_kwargs)
@@ -477,6 +477,17 @@ class InstanceManager(ABC):
             }
         }
 
+    def _get_launch_boto3_config(self):
+        """Return the boto3 config to be used by the fleet managers to launch instances."""
+        # Set the number of retries to be the max between the globally configured one and 3.
+        # This is done to try to avoid launch instances API throttling
+        # without changing the configured retries for all API calls.
+        # Adaptive mode also rate limits the calls on the client side when they are throttled.
+        configured_retry = self._boto3_config.retries.get("max_attempts", 0) if self._boto3_config.retries else 0
+        return self._boto3_config.merge(
+            Config(retries={"max_attempts": max([configured_retry, 3]), "mode": "adaptive"})
+        )
+
 
 class JobLevelScalingInstanceManager(InstanceManager):
     def __init__(
@@ -1071,18 +1082,11 @@ class JobLevelScalingInstanceManager(InstanceManager):
         return launched_ec2_instances
 
     def _get_fleet_manager(self, all_or_nothing_batch, compute_resource, queue):
-        # Set the number of retries to be the max between the globally configured one and 3.
-        # This is done to try to avoid launch instances API throttling
-        # without changing the configured retries for all API calls.
-        configured_retry = self._boto3_config.retries.get("max_attempts", 0) if self._boto3_config.retries else 0
-        boto3_config = self._boto3_config.merge(
-            Config(retries={"max_attempts": max([configured_retry, 3]), "mode": "standard"})
-        )
         # Each compute resource can be configured to use create_fleet or run_instances
         fleet_manager = FleetManagerFactory.get_manager(
             cluster_name=self._cluster_name,
             region=self._region,
-            boto3_config=boto3_config,
+            boto3_config=self._get_launch_boto3_config(),
             fleet_config=self._fleet_config,
             queue=queue,
             compute_resource=compute_resource,
@@ -1243,7 +1247,7 @@ class NodeListScalingInstanceManager(InstanceManager):
                 fleet_manager = FleetManagerFactory.get_manager(
                     self._cluster_name,
                     self._region,
-                    self._boto3_config,
+                    self._get_launch_boto3_config(),
                     self._fleet_config,
                     queue,
                     compute_resource,
@@ -15,8 +15,17 @@ from datetime import datetime, timezone
 
 import pytest
 from assertpy import assert_that
+from botocore.config import Config
 from botocore.exceptions import ClientError
-from slurm_plugin.fleet_manager import Ec2CreateFleetManager, EC2Instance, Ec2RunInstancesManager, FleetManagerFactory
+from slurm_plugin.fleet_manager import (
+    Ec2CreateFleetManager,
+    EC2Instance,
+    Ec2RunInstancesManager,
+    FleetManagerFactory,
+    _has_required_instance_fields,
+    create_fleet,
+    run_instances,
+)
 
 from tests.common import FLEET_CONFIG, MockedBoto3Request
 
@@ -54,11 +63,11 @@ class TestFleetManagerFactory:
         if expected_failure:
             with pytest.raises(Exception, match=expected_failure):
                 FleetManagerFactory.get_manager(
-                    "cluster_name", "region", "boto3_config", fleet_config, "q1", "cr1", False, {}, {}
+                    "cluster_name", "region", Config(), fleet_config, "q1", "cr1", False, {}, {}
                 )
         else:
             manager = FleetManagerFactory.get_manager(
-                "cluster_name", "region", "boto3_config", fleet_config, "q1", "cr1", False, {}, {}
+                "cluster_name", "region", Config(), fleet_config, "q1", "cr1", False, {}, {}
             )
             assert_that(manager).is_instance_of(expected_manager)
 
@@ -146,7 +155,7 @@ class TestEc2RunInstancesManager:
         fleet_manager = FleetManagerFactory.get_manager(
             "hit",
             "region",
-            "boto3_config",
+            Config(),
             FLEET_CONFIG,
             "queue1",
             compute_resource,
@@ -211,7 +220,7 @@ class TestEc2RunInstancesManager:
         boto3_stubber("ec2", mocked_boto3_request)
         # run test
         fleet_manager = FleetManagerFactory.get_manager(
-            "hit", "region", "boto3_config", FLEET_CONFIG, "queue1", "p4d24xlarge", False, {}, {}
+            "hit", "region", Config(), FLEET_CONFIG, "queue1", "p4d24xlarge", False, {}, {}
         )
         assigned_nodes = fleet_manager._launch_instances(launch_params)
         assert_that(assigned_nodes.get("Instances", [])).is_equal_to(expected_assigned_nodes)
@@ -405,7 +414,7 @@ class TestCreateFleetManager:
         caplog.set_level(logging.INFO)
         # run tests
         fleet_manager = FleetManagerFactory.get_manager(
-            "hit", "region", "boto3_config", FLEET_CONFIG, queue, compute_resource, all_or_nothing, {}, launch_overrides
+            "hit", "region", Config(), FLEET_CONFIG, queue, compute_resource, all_or_nothing, {}, launch_overrides
         )
         launch_params = fleet_manager._evaluate_launch_params(batch_size)
 
@@ -610,7 +619,7 @@ class TestCreateFleetManager:
         boto3_stubber("ec2", mocked_boto3_request)
         # run test
         fleet_manager = FleetManagerFactory.get_manager(
-            "hit", "region", "boto3_config", FLEET_CONFIG, "queue2", "fleet-ondemand", False, {}, {}
+            "hit", "region", Config(), FLEET_CONFIG, "queue2", "fleet-ondemand", False, {}, {}
         )
 
         if mocked_boto3_request[0].generate_error:
@@ -970,6 +979,67 @@ class TestCreateFleetManager:
                     [],
                 ),
             ),
+            # throttled client error
+            (
+                ["i-12345"],
+                [
+                    MockedBoto3Request(
+                        method="describe_instances",
+                        response={},
+                        expected_params={"InstanceIds": ["i-12345"]},
+                        generate_error=True,
+                        error_code="RequestLimitExceeded",
+                    ),
+                    MockedBoto3Request(
+                        method="describe_instances",
+                        response={
+                            "Reservations": [
+                                {
+                                    "Instances": [
+                                        {
+                                            "InstanceId": "i-12345",
+                                            "PrivateIpAddress": "ip-2",
+                                            "PrivateDnsName": "hostname",
+                                            "LaunchTime": datetime(2020, 1, 1, tzinfo=timezone.utc),
+                                            "NetworkInterfaces": [
+                                                {
+                                                    "Attachment": {
+                                                        "DeviceIndex": 0,
+                                                        "NetworkCardIndex": 0,
+                                                    },
+                                                    "PrivateIpAddress": "ip-2",
+                                                },
+                                            ],
+                                        },
+                                    ]
+                                }
+                            ]
+                        },
+                        expected_params={"InstanceIds": ["i-12345"]},
+                        generate_error=False,
+                    ),
+                ],
+                (
+                    [
+                        {
+                            "InstanceId": "i-12345",
+                            "PrivateIpAddress": "ip-2",
+                            "PrivateDnsName": "hostname",
+                            "LaunchTime": datetime(2020, 1, 1, tzinfo=timezone.utc),
+                            "NetworkInterfaces": [
+                                {
+                                    "Attachment": {
+                                        "DeviceIndex": 0,
+                                        "NetworkCardIndex": 0,
+                                    },
+                                    "PrivateIpAddress": "ip-2",
+                                },
+                            ],
+                        },
+                    ],
+                    [],
+                ),
+            ),
         ],
         ids=[
             "fleet_ondemand",
@@ -977,6 +1047,7 @@ class TestCreateFleetManager:
             "too_many_incomplete_instance_info",
             "client_error",
             "transitory_client_error",
+            "throttled_client_error",
         ],
     )
     def test_get_instances_info(  # Note: some tests cases are covered by test_launch_instances too.
@@ -993,12 +1064,80 @@ class TestCreateFleetManager:
         boto3_stubber("ec2", mocked_boto3_request)
         # run test
         fleet_manager = FleetManagerFactory.get_manager(
-            "hit", "region", "boto3_config", FLEET_CONFIG, "queue2", "fleet-ondemand", True, {}, {}
+            "hit", "region", Config(), FLEET_CONFIG, "queue2", "fleet-ondemand", True, {}, {}
         )
 
         complete_instances, partial_instance_ids = fleet_manager._get_instances_info(instance_ids)
         assert_that(expected_result).is_equal_to((complete_instances, partial_instance_ids))
 
+    def test_retrieve_instances_info_in_chunks(self, mocker):
+        mocker.patch("slurm_plugin.fleet_manager.DESCRIBE_INSTANCES_MAX_IDS", 2)
+        instance_info = {
+            "PrivateIpAddress": "ip-2",
+            "PrivateDnsName": "hostname",
+            "LaunchTime": datetime(2020, 1, 1, tzinfo=timezone.utc),
+            "NetworkInterfaces": [],
+        }
+
+        def _describe_instances(**kwargs):
+            instance_ids = kwargs["InstanceIds"]
+            if "i-3" in instance_ids:
+                raise ClientError({"Error": {"Code": "InvalidInstanceID.NotFound"}}, "DescribeInstances")
+            instances = [{**instance_info, "InstanceId": instance_id} for instance_id in instance_ids]
+            return {"Reservations": [{"Instances": instances}]}
+
+        ec2_client = mocker.patch("slurm_plugin.fleet_manager.boto3").client.return_value
+        ec2_client.describe_instances.side_effect = _describe_instances
+        fleet_manager = FleetManagerFactory.get_manager(
+            "hit", "region", Config(), FLEET_CONFIG, "queue2", "fleet-ondemand", True, {}, {}
+        )
+
+        complete_instances, partial_instance_ids = fleet_manager._retrieve_instances_info_from_ec2(
+            ["i-1", "i-2", "i-3", "i-4", "i-5"]
+        )
+
+        # A failing chunk only marks its own instances as partial
+        assert_that([instance["InstanceId"] for instance in complete_instances]).is_equal_to(["i-1", "i-2", "i-5"])
+        assert_that(partial_instance_ids).is_equal_to(["i-3", "i-4"])
+        assert_that(
+            sorted(call.kwargs["InstanceIds"] for call in ec2_client.describe_instances.call_args_list)
+        ).is_equal_to([["i-1", "i-2"], ["i-3", "i-4"], ["i-5"]])
+
+    @pytest.mark.parametrize(
+        ("attempt_count", "expected_delay"),
+        [(1, 1.2), (3, 4.8), (10, 30)],
+    )
+    def test_get_backoff_delay(self, mocker, attempt_count, expected_delay):
+        uniform_mock = mocker.patch("slurm_plugin.fleet_manager.random.uniform", return_value=0.1)
+
+        assert_that(Ec2CreateFleetManager._get_backoff_delay(attempt_count)).is_close_to(expected_delay / 2 + 0.1, 1e-9)
+        uniform_mock.assert_called_once_with(0, pytest.approx(expected_delay / 2))
+
+    @pytest.mark.parametrize(
+        ("jitter", "expected_first_delay", "expected_total_delay"),
+        [
+            (lambda low, high: low, 0.6, 9.0),
+            (lambda low, high: high, 1.2, 18.0),
+        ],
+        ids=["min_jitter", "max_jitter"],
+    )
+    def test_get_instances_info_cumulative_delay(self, mocker, jitter, expected_first_delay, expected_total_delay):
+        mocker.patch("slurm_plugin.fleet_manager.random.uniform", side_effect=jitter)
+        sleep_mock = mocker.patch("time.sleep")
+        fleet_manager = FleetManagerFactory.get_manager(
+            "hit", "region", Config(), FLEET_CONFIG, "queue2", "fleet-ondemand", True, {}, {}
+        )
+        fleet_manager._retrieve_instances_info_from_ec2 = mocker.MagicMock(return_value=([], ["i-12345"]))
+
+        _, partial_instance_ids = fleet_manager._get_instances_info(["i-12345"])
+
+        delays = [call.args[0] for call in sleep_mock.call_args_list]
+        assert_that(partial_instance_ids).is_equal_to(["i-12345"])
+        assert_that(delays).is_length(4)
+        assert_that(delays[0]).is_close_to(expected_first_delay, 1e-9)
+        # The total wait must not be shorter than the 9 seconds waited before jitter was applied to the whole delay
+        assert_that(sum(delays)).is_close_to(expected_total_delay, 1e-9)
+
     @pytest.mark.parametrize(
         ("instance_ids", "mocked_boto3_request", "expected_result"),
         [
@@ -1079,7 +1218,7 @@ class TestFleetManager:
     )
     def test_launch_ec2_instances(self, mocker, count, job_id):
         fleet_manager = FleetManagerFactory.get_manager(
-            "hit", "region", "boto3_config", FLEET_CONFIG, "queue2", "fleet-ondemand", True, {}, {}
+            "hit", "region", Config(), FLEET_CONFIG, "queue2", "fleet-ondemand", True, {}, {}
         )
 
         # patch internal functions
@@ -1099,3 +1238,180 @@ class TestFleetManager:
 
         fleet_manager._evaluate_launch_params.assert_called_once_with(count)
         fleet_manager._launch_instances.assert_called_once()
+
+    def test_ec2_client_is_cached(self, mocker):
+        boto3_mock = mocker.patch("slurm_plugin.fleet_manager.boto3")
+        fleet_manager = FleetManagerFactory.get_manager(
+            "hit", "region", Config(), FLEET_CONFIG, "queue2", "fleet-ondemand", True, {}, {}
+        )
+
+        boto3_mock.client.assert_not_called()
+        assert_that(fleet_manager.ec2_client).is_equal_to(fleet_manager.ec2_client)
+        boto3_mock.client.assert_called_once_with("ec2", region_name="region", config=fleet_manager._boto3_config)
+
+    def test_ec2_client_not_created_with_override(self, mocker):
+        boto3_mock = mocker.patch("slurm_plugin.fleet_manager.boto3")
+        override = mocker.patch("slurm_plugin.fleet_manager._run_instances_override")
+        fleet_manager = FleetManagerFactory.get_manager(
+            "hit", "region", Config(), FLEET_CONFIG, "queue1", "c5xlarge", False, {}, {}
+        )
+
+        fleet_manager._launch_instances({"MinCount": 1})
+
+        override.assert_called_once()
+        boto3_mock.client.assert_not_called()
+
+    @pytest.mark.parametrize(
+        ("boto3_config", "expected_retries", "expected_max_pool_connections", "expected_proxies"),
+        [
+            (Config(), {"max_attempts": 5, "mode": "adaptive"}, 50, None),
+            (
+                Config(retries={"max_attempts": 3, "mode": "standard"}, proxies={"https": "proxy"}),
+                {"max_attempts": 3, "mode": "standard"},
+                50,
+                {"https": "proxy"},
+            ),
+            (Config(max_pool_connections=5), {"max_attempts": 5, "mode": "adaptive"}, 5, None),
+        ],
+        ids=["defaults", "caller_retries", "caller_pool_size"],
+    )
+    def test_boto3_config(self, boto3_config, expected_retries, expected_max_pool_connections, expected_proxies):
+        fleet_manager = FleetManagerFactory.get_manager(
+            "hit", "region", boto3_config, FLEET_CONFIG, "queue2", "fleet-ondemand", True, {}, {}
+        )
+
+        assert_that(fleet_manager._boto3_config.retries).is_equal_to(expected_retries)
+        assert_that(fleet_manager._boto3_config.max_pool_connections).is_equal_to(expected_max_pool_connections)
+        assert_that(fleet_manager._boto3_config.proxies).is_equal_to(expected_proxies)
+
+
+@pytest.mark.parametrize(
+    ("instance_info", "expected_result"),
+    [
+        (
+            {
+                "InstanceId": "i-12345",
+                "PrivateIpAddress": "ip-2",
+                "PrivateDnsName": "hostname",
+                "LaunchTime": datetime(2020, 1, 1, tzinfo=timezone.utc),
+                "NetworkInterfaces": [{"Attachment": {"DeviceIndex": 0, "NetworkCardIndex": 0}}],
+            },
+            True,
+        ),
+        (
+            {
+                "InstanceId": "i-12345",
+                "PrivateDnsName": "hostname",
+                "LaunchTime": datetime(2020, 1, 1, tzinfo=timezone.utc),
+                "NetworkInterfaces": [{"Attachment": {"DeviceIndex": 0, "NetworkCardIndex": 0}}],
+            },
+            False,
+        ),
+        (
+            {
+                "InstanceId": "i-12345",
+                "PrivateIpAddress": "ip-2",
+                "PrivateDnsName": "hostname",
+                "LaunchTime": datetime(2020, 1, 1, tzinfo=timezone.utc),
+                "NetworkInterfaces": [{"PrivateIpAddress": "ip-2"}],
+            },
+            False,
+        ),
+        (
+            {
+                "InstanceId": "i-12345",
+                "PrivateIpAddress": "ip-2",
+                "PrivateDnsName": "hostname",
+                "LaunchTime": datetime(2020, 1, 1, tzinfo=timezone.utc),
+                "NetworkInterfaces": [],
+            },
+            True,
+        ),
+    ],
+    ids=["complete", "missing_private_ip", "missing_attachment", "no_network_interfaces"],
+)
+def test_has_required_instance_fields(instance_info, expected_result):
+    assert_that(_has_required_instance_fields(instance_info)).is_equal_to(expected_result)
+    if expected_result:
+        # The instance info must be usable to build an EC2Instance
+        EC2Instance.from_describe_instance_data(instance_info)
+
+
+def test_ec2_instance():
+    launch_time = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    instance = EC2Instance("i-12345", "ip-1", "hostname", launch_time)
+    other_instance = EC2Instance("i-12345", "ip-1", "hostname", launch_time)
+    other_instance.slurm_node = "node"
+
+    assert_that(instance.slurm_node).is_none()
+    assert_that(instance).is_equal_to(other_instance)
+    assert_that(instance).is_not_equal_to(EC2Instance("i-23456", "ip-1", "hostname", launch_time))
+    assert_that(instance).is_not_equal_to("i-12345")
+    assert_that(hash(instance)).is_equal_to(hash("i-12345"))
+    assert_that(str(instance)).is_equal_to("i-12345")
+    assert_that(repr(instance)).is_equal_to(
+        f"EC2Instance(id='i-12345', private_ip='ip-1', hostname='hostname', launch_time={launch_time!r})"
+    )
+    assert_that(hasattr(instance, "__dict__")).is_false()
+
+
+def _describe_instances_response(instance_ids, next_token=None):
+    response = {"Reservations": [{"Instances": [{"InstanceId": instance_id} for instance_id in instance_ids]}]}
+    if next_token:
+        response["NextToken"] = next_token
+    return response
+
+
+@pytest.mark.parametrize(
+    ("responses", "expected_calls"),
+    [
+        (
+            [_describe_instances_response(["i-1", "i-2"])],
+            [{"InstanceIds": ["i-1", "i-2"]}],
+        ),
+        (
+            [_describe_instances_response(["i-1"], "token"), _describe_instances_response(["i-2"])],
+            [{"InstanceIds": ["i-1", "i-2"]}, {"InstanceIds": ["i-1", "i-2"], "NextToken": "token"}],
+        ),
+        (
+            [_describe_instances_response(["i-1", "i-2"], "token")],
+            [{"InstanceIds": ["i-1", "i-2"]}],
+        ),
+    ],
+    ids=["single_page", "multiple_pages", "all_instances_in_first_page"],
+)
+def test_describe_instances(mocker, responses, expected_calls):
+    ec2_client = mocker.MagicMock()
+    ec2_client.describe_instances.side_effect = responses
+
+    instances_info = Ec2CreateFleetManager._describe_instances(ec2_client, ["i-1", "i-2"])
+
+    assert_that(instances_info).is_equal_to([{"InstanceId": "i-1"}, {"InstanceId": "i-2"}])
+    assert_that(ec2_client.describe_instances.call_args_list).is_equal_to(
+        [mocker.call(**kwargs) for kwargs in expected_calls]
+    )
+
+
+@pytest.mark.parametrize(
+    ("launch_function", "override_name", "api"),
+    [
+        (run_instances, "_run_instances_override", "run_instances"),
+        (create_fleet, "_create_fleet_override", "create_fleet"),
+    ],
+)
+@pytest.mark.parametrize("override_available", [True, False])
+def test_launch_api_override(mocker, launch_function, override_name, api, override_available):
+    override = mocker.MagicMock() if override_available else None
+    mocker.patch(f"slurm_plugin.fleet_manager.{override_name}", override)
+    ec2_client = mocker.MagicMock()
+
+    ec2_client_factory = mocker.MagicMock(return_value=ec2_client)
+
+    launch_function("region", "boto3_config", {"param": "value"}, ec2_client_factory=ec2_client_factory)
+
+    if override_available:
+        override.assert_called_once_with(region="region", boto3_config="boto3_config", param="value")
+        ec2_client_factory.assert_not_called()
+    else:
+        ec2_client_factory.assert_called_once()
+        getattr(ec2_client, api).assert_called_once_with(param="value")
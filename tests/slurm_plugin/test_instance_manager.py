@@ -1370,6 +1370,40 @@ class TestInstanceManager:
                 all_or_nothing_batch=all_or_nothing_batch,
             )
 
+    @pytest.mark.parametrize("job_level_scaling", [True, False])
+    @pytest.mark.parametrize(
+        ("boto3_config", "expected_retries"),
+        [
+            (botocore.config.Config(), {"max_attempts": 3, "mode": "adaptive"}),
+            (
+                botocore.config.Config(retries={"max_attempts": 10, "mode": "standard"}, proxies={"https": "proxy"}),
+                {"max_attempts": 10, "mode": "adaptive"},
+            ),
+        ],
+        ids=["default", "configured_retries"],
+    )
+    def test_get_launch_boto3_config(self, job_level_scaling, boto3_config, expected_retries):
+        instance_manager = InstanceManagerFactory.get_manager(
+            region="us-east-2",
+            cluster_name="hit",
+            boto3_config=boto3_config,
+            table_name=None,
+            head_node_private_ip="head.node.ip",
+            head_node_hostname="head-node-hostname",
+            hosted_zone=None,
+            dns_domain=None,
+            use_private_hostname=False,
+            fleet_config=FLEET_CONFIG,
+            run_instances_overrides={},
+            create_fleet_overrides={},
+            job_level_scaling=job_level_scaling,
+        )
+
+        launch_boto3_config = instance_manager._get_launch_boto3_config()
+
+        assert_that(launch_boto3_config.retries).is_equal_to(expected_retries)
+        assert_that(launch_boto3_config.proxies).is_equal_to(boto3_config.proxies)
+
 
 class TestJobLevelScalingInstanceManager:
     @pytest.fixture